@@ -12,17 +12,42 @@ Author: Chris Judd
 License: MIT
 """
 
+import atexit
+import bisect
+import codecs
+import ctypes
+import functools
+import graphlib
+import hashlib
+import http.client
+import itertools
 import json
 import os
+import queue
 import re
+import select
+import shutil
 import signal
+import socket
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import textwrap
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Tuple, Dict
+from typing import Callable, Optional, List, Tuple, Dict, Set
+
+try:
+    import orjson as _json_fast
+except ImportError:
+    _json_fast = None
 
 # ============================================================================
 # CONFIGURATION PATHS
@@ -32,8 +57,12 @@ ADDON_OPTIONS_PATH = Path("/data/options.json")
 STATE_PATH         = Path("/data/state.json")
 LOG_FILE           = Path("/config/esphome_smart_update.log")
 PROGRESS_FILE      = Path("/config/esphome_update_progress.json")
+PROGRESS_JOURNAL   = Path("/config/esphome_update_progress.jsonl")
+COMPILE_CACHE_FILE = Path("/config/esphome_compile_cache.json")
+DISCOVER_CACHE_FILE = Path("/data/discover_cache.json")
 ESPHOME_CONFIG_DIR = Path("/config/esphome")
 DASHBOARD_JSON     = ESPHOME_CONFIG_DIR / ".dashboard.json"
+BUILDS_DIR         = ESPHOME_CONFIG_DIR / "builds"
 
 DEFAULTS = {
     "ota_password": "",
@@ -42,6 +71,8 @@ DEFAULTS = {
     "esphome_container": "addon_15ef4d2f_esphome",
     "dry_run": False,
     "max_devices_per_run": 0,
+    "parallel_updates": 2,
+    "force_update": False,
     "start_from_device": "",
     "update_only_these": [],
     "clear_log_now": False,
@@ -55,27 +86,142 @@ DEFAULTS = {
 # GLOBAL STATE
 # ============================================================================
 
-STOP_REQUESTED = False
-CURRENT_CHILD: Optional[subprocess.Popen] = None
+STOP_EVENT = threading.Event()
+CURRENT_CHILDREN: Set[subprocess.Popen] = set()
+CURRENT_STREAMS: Set[socket.socket] = set()
+_LOG_FH = None
+_LOG_LOCK = threading.RLock()
+_LOG_CONTEXT = threading.local()  # .prefix tags lines from device workers
+_LOG_QUEUE: "queue.SimpleQueue" = queue.SimpleQueue()
+_LOG_WRITER: Optional[threading.Thread] = None
+_KNOWN_CONTAINERS: Optional[frozenset] = None
 
 # ============================================================================
 # LOGGING UTILITIES
 # ============================================================================
 
-def ts() -> str:
-    """Return formatted timestamp"""
-    return datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+LOG_BATCH_SIZE = 256  # queued lines written per write()/flush()
+
+_LOG_TRUNCATE = object()  # queue marker: empty the log file here
+_LOG_STOP = object()      # queue marker: writer exits after this
+_TS_CACHE: Tuple[int, str] = (-1, "")
+
+def ts(when: Optional[float] = None) -> str:
+    """Return formatted timestamp (formatted once per second)"""
+    global _TS_CACHE
+    when = time.time() if when is None else when
+    second = int(when)
+    cached = _TS_CACHE
+    if cached[0] != second:
+        cached = (second, datetime.fromtimestamp(second).strftime("[%Y-%m-%d %H:%M:%S]"))
+        _TS_CACHE = cached
+    return cached[1]
+
+def _open_log():
+    """Open the persistent log file handle (once)"""
+    global _LOG_FH
+    if _LOG_FH is None:
+        LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+        _LOG_FH = LOG_FILE.open("a", encoding="utf-8", buffering=8192)
+    return _LOG_FH
 
-def log(msg: str):
-    """Log message to both stdout and file"""
-    line = f"{ts()} {msg}"
-    print(line, flush=True)
+def _close_log():
+    """Flush and close the persistent log file handle"""
+    global _LOG_FH
+    if _LOG_FH is not None:
+        try:
+            _LOG_FH.close()
+        except Exception:
+            pass
+        _LOG_FH = None
+
+def _write_log(text: str):
+    """Write formatted lines to stdout and the log file"""
+    with _LOG_LOCK:
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except Exception:
+            pass
+        try:
+            fh = _open_log()
+            fh.write(text)
+            fh.flush()
+        except Exception:
+            pass
+
+def _truncate_log():
+    """Close and empty the log file"""
+    with _LOG_LOCK:
+        _close_log()
+        try:
+            LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with LOG_FILE.open("w", encoding="utf-8"):
+                pass
+        except Exception as e:
+            _write_log(f"{ts()} Warning: failed to truncate {LOG_FILE}: {e}\n")
+
+def _log_writer():
+    """Drain the log queue in batches: one write and flush per batch"""
+    while True:
+        batch = [_LOG_QUEUE.get()]
+        try:
+            while len(batch) < LOG_BATCH_SIZE:
+                batch.append(_LOG_QUEUE.get_nowait())
+        except queue.Empty:
+            pass
+        
+        lines = []
+        for item in batch:
+            if item is _LOG_STOP or item is _LOG_TRUNCATE:
+                if lines:
+                    _write_log("".join(lines))
+                    lines = []
+                if item is _LOG_STOP:
+                    return
+                _truncate_log()
+            else:
+                when, prefix, msg = item
+                lines.append(f"{ts(when)} {prefix}{msg}\n")
+        if lines:
+            _write_log("".join(lines))
+
+def start_log_writer():
+    """Move log output onto a background writer thread"""
+    global _LOG_WRITER
+    if _LOG_WRITER is None:
+        _LOG_WRITER = threading.Thread(target=_log_writer, name="log-writer", daemon=True)
+        _LOG_WRITER.start()
+
+def stop_log_writer():
+    """Write everything still queued, then go back to writing synchronously"""
+    global _LOG_WRITER
+    writer, _LOG_WRITER = _LOG_WRITER, None
+    if writer is not None:
+        _LOG_QUEUE.put(_LOG_STOP)
+        writer.join(timeout=10)
+    # Anything queued after the stop marker
     try:
-        LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with LOG_FILE.open("a", encoding="utf-8") as f:
-            f.write(line + "\n")
-    except Exception:
+        while True:
+            item = _LOG_QUEUE.get_nowait()
+            if item is _LOG_TRUNCATE:
+                _truncate_log()
+            elif item is not _LOG_STOP:
+                when, prefix, msg = item
+                _write_log(f"{ts(when)} {prefix}{msg}\n")
+    except queue.Empty:
         pass
+    _close_log()
+
+atexit.register(stop_log_writer)
+
+def log(msg: str):
+    """Log message to both stdout and file (queued while the writer runs)"""
+    item = (time.time(), getattr(_LOG_CONTEXT, "prefix", ""), msg)
+    if _LOG_WRITER is not None:
+        _LOG_QUEUE.put_nowait(item)
+    else:
+        _write_log(f"{ts(item[0])} {item[1]}{msg}\n")
 
 def log_header(title: str):
     """Log a section header"""
@@ -90,6 +236,13 @@ def log_section(title: str):
 
 def truncate_file(path: Path):
     """Clear a file's contents"""
+    if path == LOG_FILE:
+        # In order with the lines logged before it
+        if _LOG_WRITER is not None:
+            _LOG_QUEUE.put_nowait(_LOG_TRUNCATE)
+        else:
+            _truncate_log()
+        return
     try:
         path.parent.mkdir(parents=True, exist_ok=True)
         with path.open("w", encoding="utf-8"):
@@ -103,19 +256,27 @@ def truncate_file(path: Path):
 
 def _sig_handler(signum, frame):
     """Handle SIGTERM/SIGINT for graceful shutdown"""
-    global STOP_REQUESTED, CURRENT_CHILD
-    STOP_REQUESTED = True
+    STOP_EVENT.set()
     log("")
     log("⚠ Stop signal received - shutting down gracefully...")
     
-    if CURRENT_CHILD and CURRENT_CHILD.poll() is None:
+    for child in list(CURRENT_CHILDREN):
+        if child.poll() is not None:
+            continue
         try:
-            os.killpg(os.getpgid(CURRENT_CHILD.pid), signal.SIGTERM)
+            os.killpg(os.getpgid(child.pid), signal.SIGTERM)
         except Exception:
             try:
-                CURRENT_CHILD.terminate()
+                child.terminate()
             except Exception:
                 pass
+    
+    # Unblock readers of Docker API output streams
+    for sock in list(CURRENT_STREAMS):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
 
 signal.signal(signal.SIGTERM, _sig_handler)
 signal.signal(signal.SIGINT, _sig_handler)
@@ -124,29 +285,70 @@ signal.signal(signal.SIGINT, _sig_handler)
 # JSON UTILITIES
 # ============================================================================
 
+def json_loads(raw: bytes):
+    """Parse JSON bytes (orjson when available)"""
+    if _json_fast is not None:
+        return _json_fast.loads(raw)
+    return json.loads(raw)
+
+def json_dumps(data, compact: bool = False) -> bytes:
+    """
+    Serialize to JSON bytes (orjson when available)
+    Indented and key-sorted by default; compact skips both
+    """
+    if _json_fast is not None:
+        if compact:
+            return _json_fast.dumps(data)
+        return _json_fast.dumps(data, option=_json_fast.OPT_INDENT_2 | _json_fast.OPT_SORT_KEYS)
+    if compact:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return json.dumps(data, indent=2, sort_keys=True).encode("utf-8")
+
 def load_json(path: Path, default):
     """Load JSON file with fallback"""
     if path.exists():
         try:
-            return json.loads(path.read_text(encoding="utf-8"))
+            return json_loads(path.read_bytes())
         except Exception:
             return default
     return default
 
-def save_json(path: Path, data: dict):
-    """Save data as JSON"""
+def save_json(path: Path, data: dict, compact: bool = False) -> bool:
+    """
+    Save data as JSON (skipped when the file already holds the same bytes)
+    Written to a temporary file and renamed, so a reader never sees half a file
+    Returns: True if the file now holds data
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
     try:
+        payload = json_dumps(data, compact=compact)
+        try:
+            if path.stat().st_size == len(payload) and path.read_bytes() == payload:
+                return True
+        except OSError:
+            pass
         path.parent.mkdir(parents=True, exist_ok=True)
-        path.write_text(json.dumps(data, indent=2, sort_keys=True), encoding="utf-8")
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, path)
+        return True
     except Exception as e:
         log(f"Warning: failed to write {path}: {e}")
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        return False
+
+def save_json_fast(path: Path, data: dict) -> bool:
+    """Save data as compact JSON, for files rewritten often during a run"""
+    return save_json(path, data, compact=True)
 
 def load_options() -> Dict:
     """Load add-on options with defaults"""
     opts = DEFAULTS.copy()
     if ADDON_OPTIONS_PATH.exists():
         try:
-            loaded = json.loads(ADDON_OPTIONS_PATH.read_text(encoding="utf-8"))
+            loaded = json_loads(ADDON_OPTIONS_PATH.read_bytes())
             for k in DEFAULTS:
                 if k in loaded:
                     opts[k] = loaded[k]
@@ -164,26 +366,286 @@ def load_state() -> Dict:
 
 def save_state(state: Dict):
     """Save persistent state"""
-    save_json(STATE_PATH, state)
+    save_json_fast(STATE_PATH, state)
+
+PROGRESS_COMPACT_EVERY = 20  # journal events between progress file rewrites
+RETRY_BACKOFF_BASE     = 60    # seconds; doubles with every failed attempt
+RETRY_BACKOFF_MAX      = 3600
+
+_PROGRESS_LOCK = threading.RLock()
+_PROGRESS_EVENTS = 0
+
+def _insort_unique(names: List[str], name: str):
+    """Insert name into a sorted list unless already present"""
+    i = bisect.bisect_left(names, name)
+    if i == len(names) or names[i] != name:
+        names.insert(i, name)
+
+def _remove_sorted(names: List[str], name: str):
+    """Remove name from a sorted list if present"""
+    i = bisect.bisect_left(names, name)
+    if i < len(names) and names[i] == name:
+        del names[i]
+
+def _apply_progress_event(
+    progress: Dict,
+    name: str,
+    status: str,
+    reason: str = "",
+    when: Optional[float] = None
+):
+    """
+    Fold one device result into the progress (sorted lists; failed devices
+    map to their attempt count and retry cooldown)
+    """
+    if status == "done":
+        _insort_unique(progress["done"], name)
+        progress["failed"].pop(name, None)
+    elif status == "failed":
+        entry = progress["failed"].get(name) or {"attempts": 0}
+        attempts = entry["attempts"] + 1
+        when = time.time() if when is None else when
+        progress["failed"][name] = {
+            "attempts": attempts,
+            "next_retry_at": when + min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempts),
+            "last_reason": reason or entry.get("last_reason", ""),
+        }
+    elif status == "skipped":
+        _insort_unique(progress["skipped"], name)
+
+def retry_wait(progress: Dict, name: str, now: Optional[float] = None) -> float:
+    """Seconds until a failed device may be retried (0 if it may now)"""
+    entry = progress["failed"].get(name)
+    if not entry:
+        return 0.0
+    now = time.time() if now is None else now
+    return max(0.0, entry.get("next_retry_at", 0) - now)
 
 def load_progress() -> Dict:
-    """Load update progress"""
-    return load_json(PROGRESS_FILE, {
+    """Load update progress, replaying results journaled since the last save"""
+    progress = load_json(PROGRESS_FILE, {
         "done": [],
-        "failed": [],
+        "failed": {},
         "skipped": []
     })
+    # Kept sorted and unique from here on, so saving needs no re-sort
+    for key in ("done", "skipped"):
+        progress[key] = sorted(set(progress.get(key, [])))
+    
+    # Older versions kept failed devices as a plain list: retry them now
+    failed = progress.get("failed") or {}
+    if isinstance(failed, list):
+        failed = {name: {"attempts": 1, "next_retry_at": 0, "last_reason": ""} for name in failed}
+    progress["failed"] = failed
+    
+    # Events numbered at or below journal_seq are already in the progress
+    # file (the journal was not emptied after the last save)
+    events = 0
+    try:
+        with open(PROGRESS_JOURNAL, "rb") as fh:
+            for line in fh:
+                try:
+                    event = json_loads(line)
+                    seq = event.get("seq")
+                    if seq is not None:
+                        if seq <= progress.get("journal_seq", 0):
+                            continue
+                        progress["journal_seq"] = seq
+                    _apply_progress_event(
+                        progress, event["name"], event["status"],
+                        event.get("reason", ""), event.get("ts")
+                    )
+                    events += 1
+                except Exception:
+                    continue  # Torn final line from an interrupted write
+    except OSError:
+        pass
+    
+    if events:
+        save_progress(progress)
+    return progress
 
-def save_progress(data: dict):
-    """Save update progress"""
-    save_json(PROGRESS_FILE, data)
+def save_progress(data: dict) -> bool:
+    """
+    Save update progress, then empty the journal it now includes
+    The journal is kept if the save fails, so no result is lost
+    """
+    global _PROGRESS_EVENTS
+    with _PROGRESS_LOCK:
+        if not save_json_fast(PROGRESS_FILE, data):
+            return False
+        try:
+            os.truncate(PROGRESS_JOURNAL, 0)
+        except OSError:
+            pass
+        _PROGRESS_EVENTS = 0
+        return True
+
+def append_progress_event(progress: Dict, name: str, status: str, reason: str = ""):
+    """
+    Record one device result: a single fsynced line appended to the journal,
+    with a full progress file rewrite only every PROGRESS_COMPACT_EVERY events
+    """
+    global _PROGRESS_EVENTS
+    with _PROGRESS_LOCK:
+        now = time.time()
+        _apply_progress_event(progress, name, status, reason, now)
+        seq = progress.get("journal_seq", 0) + 1
+        progress["journal_seq"] = seq
+        
+        event = {"name": name, "status": status, "ts": now, "seq": seq}
+        if reason:
+            event["reason"] = reason
+        line = json_dumps(event, compact=True) + b"\n"
+        try:
+            fd = os.open(PROGRESS_JOURNAL, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            log(f"Warning: failed to write {PROGRESS_JOURNAL}: {e}")
+        _PROGRESS_EVENTS += 1
+        if _PROGRESS_EVENTS >= PROGRESS_COMPACT_EVERY:
+            save_progress(progress)
 
 # ============================================================================
 # NETWORK UTILITIES
 # ============================================================================
 
+_ICMP_SEQ = itertools.count(1)
+
+MDNS_CACHE_TTL = 300  # seconds
+mdns_cache: Dict[str, Tuple[str, float]] = {}  # hostname -> (ip, expires_at)
+_MDNS_LOCK = threading.Lock()
+
+def _icmp_checksum(data: bytes) -> int:
+    """RFC 1071 internet checksum"""
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def _is_mdns_name(host: str) -> bool:
+    return host.lower().rstrip(".").endswith(".local")
+
+def lookup_mdns(hostname: str) -> Optional[str]:
+    """
+    IPv4 address of a .local name, cached for MDNS_CACHE_TTL seconds
+    Returns: the address, or None when the name does not resolve
+    """
+    now = time.monotonic()
+    with _MDNS_LOCK:
+        cached = mdns_cache.get(hostname)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    try:
+        infos = socket.getaddrinfo(hostname, None, socket.AF_INET, socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return None
+    if not infos:
+        return None
+    
+    address = infos[0][4][0]
+    with _MDNS_LOCK:
+        mdns_cache[hostname] = (address, now + MDNS_CACHE_TTL)
+    return address
+
+def _resolve_ipv4(host: str) -> Optional[str]:
+    """IPv4 address for host, or None when it does not resolve"""
+    if _is_mdns_name(host):
+        return lookup_mdns(host)
+    try:
+        return socket.gethostbyname(host)
+    except (OSError, UnicodeError):
+        return None
+
+def _ping_icmp_many(hosts: List[str], timeout: float = 1.0) -> Dict[str, bool]:
+    """
+    Send one ICMP echo request to each host over a single socket and collect
+    the replies with select, without spawning ping or a thread per host
+    Hosts that do not resolve are left out of the result.
+    Raises OSError when no ICMP socket can be opened
+    """
+    # Unprivileged ICMP datagram socket first, raw socket as a fallback
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        raw = False
+    except OSError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        raw = True
+
+    ident = os.getpid() & 0xFFFF
+    payload = b"esphome-selective-updates"
+    results = {}
+    pending = {}  # (address, seq) -> hosts awaiting that reply
+
+    # Resolve every name up front and concurrently, so offline .local names
+    # cost one resolver timeout in total rather than one each
+    with ThreadPoolExecutor(max_workers=min(32, len(hosts) or 1)) as pool:
+        addresses = dict(zip(hosts, pool.map(_resolve_ipv4, hosts)))
+
+    with sock:
+        for host, addr in addresses.items():
+            if addr is None:
+                continue
+            seq = next(_ICMP_SEQ) & 0xFFFF
+            header = struct.pack("!BBHHH", 8, 0, 0, ident, seq)
+            packet = struct.pack("!BBHHH", 8, 0, _icmp_checksum(header + payload), ident, seq) + payload
+            results[host] = False
+            try:
+                sock.sendto(packet, (addr, 0))
+            except OSError:
+                continue  # e.g. ENETUNREACH: this host only is unreachable
+            pending.setdefault((addr, seq), []).append(host)
+
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or STOP_EVENT.is_set():
+                break
+            ready, _, _ = select.select([sock], [], [], min(remaining, 0.2))
+            if not ready:
+                continue
+            data, (src, _) = sock.recvfrom(1024)
+            if raw:
+                # Raw sockets deliver the IP header too
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, r_ident, r_seq = struct.unpack("!BBHHH", data[:8])
+            # The kernel rewrites the identifier on datagram sockets
+            if icmp_type != 0 or (raw and r_ident != ident):
+                continue
+            for host in pending.pop((src, r_seq), []):
+                results[host] = True
+
+    return results
+
+def _ping_icmp(host: str, timeout: float = 1.0) -> bool:
+    """
+    Send a single ICMP echo request without spawning ping
+    Raises OSError when no ICMP socket can be opened (or host won't resolve)
+    """
+    result = _ping_icmp_many([host], timeout)
+    if host not in result:
+        raise OSError(f"cannot resolve {host}")
+    return result[host]
+
 def ping_host(host: str) -> bool:
     """Check if host is reachable via ping"""
+    if STOP_EVENT.is_set():
+        return False
+
+    try:
+        return _ping_icmp(host)
+    except OSError:
+        pass  # No ICMP socket available; fall back to the ping binary
+
     for args in (["-c", "1", "-w", "1"], ["-c", "1", "-W", "1"]):
         try:
             rc = subprocess.run(
@@ -200,12 +662,89 @@ def ping_host(host: str) -> bool:
             pass
     return False
 
+def ping_hosts(hosts: List[str]) -> Dict[str, bool]:
+    """Ping several hosts concurrently; returns {host: reachable}"""
+    unique = list(dict.fromkeys(h for h in hosts if h))
+    if not unique or STOP_EVENT.is_set():
+        return {h: False for h in unique}
+
+    # All at once over one ICMP socket where possible
+    try:
+        results = _ping_icmp_many(unique)
+    except OSError:
+        results = {}
+
+    # Unresolvable hosts, or no ICMP socket: ping binary, one thread each
+    rest = [h for h in unique if h not in results]
+    if rest:
+        with ThreadPoolExecutor(max_workers=min(32, len(rest))) as executor:
+            results.update(zip(rest, executor.map(ping_host, rest)))
+    return results
+
+def resolve_target(node: str, ip: Optional[str]) -> str:
+    """
+    OTA target for a device: its configured address (default {node}.local),
+    with .local names replaced by the IP they resolve to (cached)
+    """
+    target = ip or f"{node}.local"
+    if not _is_mdns_name(target):
+        return target
+    # Unresolved names are left for ESPHome to resolve
+    return lookup_mdns(target) or target
+
+def ping_phase(devices: List[dict], skip_offline: bool = True) -> Set[str]:
+    """
+    Ping every device address up front, concurrently, and resolve the
+    .local names of the rest (ping resolution caches pinged .local names)
+    Returns: set of reachable addresses (every address if skip_offline is off)
+    """
+    hosts = [d["address"] for d in devices if d["address"]]
+    pinging = skip_offline and bool(hosts)
+    
+    # Warm the mDNS cache alongside the pings, keyed like resolve_target
+    names = {d["address"] or f"{d['node']}.local" for d in devices
+             if not (pinging and d["address"])}
+    names = [name for name in names if _is_mdns_name(name)]
+    resolver = None
+    if names:
+        resolver = ThreadPoolExecutor(max_workers=min(32, len(names)))
+        for name in names:
+            resolver.submit(lookup_mdns, name)
+    
+    try:
+        if not skip_offline or not hosts:
+            return set(hosts)
+        
+        log("")
+        log(f"Checking reachability of {len(hosts)} device(s)...")
+        results = ping_hosts(hosts)
+    finally:
+        if resolver is not None:
+            resolver.shutdown(wait=True)
+    
+    reachable = {host for host, ok in results.items() if ok}
+    log(f"Reachability: {len(reachable)} online, {len(results) - len(reachable)} offline")
+    return reachable
+
 # ============================================================================
 # ESPHOME YAML PARSING
 # ============================================================================
 
-ESPHOME_NAME_RE = re.compile(r"^esphome:\s*$", re.MULTILINE)
-NAME_LINE_RE    = re.compile(r"^\s+name\s*:\s*(\S+)\s*$")
+ESPHOME_NAME_RE   = re.compile(r"^esphome:\s*$", re.MULTILINE)
+NAME_LINE_RE      = re.compile(r"^\s+name\s*:\s*(\S+)\s*$")
+_FALLBACK_NAME_RE = re.compile(r"^\s*name\s*:\s*([^\s#]+)", re.MULTILINE)
+_LINE_RE          = re.compile(r"^.*$", re.MULTILINE)
+
+# use_address / manual_ip / domain in a single scan, in that priority order
+ADDRESS_RE = re.compile(
+    r"use_address:\s*(?P<use_address>.*)"
+    r"|manual_ip\s*:\s*(?P<ip>\d{1,3}(?:\.\d{1,3}){3})"
+    r"|domain:\s*(?P<domain>.+)"
+)
+
+# Update ordering hints, declared as substitutions (ESPHome rejects unknown keys)
+PRIORITY_RE   = re.compile(r"^\s+update_priority\s*:\s*['\"]?(-?\d+)", re.MULTILINE)
+DEPENDS_ON_RE = re.compile(r"^\s+update_depends_on\s*:\s*(.+)$", re.MULTILINE)
 
 def parse_node_name(yaml_text: str) -> Optional[str]:
     """Extract ESPHome device name from YAML config"""
@@ -213,22 +752,16 @@ def parse_node_name(yaml_text: str) -> Optional[str]:
     m = ESPHOME_NAME_RE.search(yaml_text)
     if not m:
         # Fallback: look for top-level 'name:'
-        m2 = re.search(r"^\s*name\s*:\s*([^\s#]+)", yaml_text, re.MULTILINE)
+        m2 = _FALLBACK_NAME_RE.search(yaml_text)
         return m2.group(1).strip() if m2 else None
     
-    start = m.end()
-    # Extract indented lines following 'esphome:'
-    block = []
-    for line in yaml_text[start:].splitlines():
+    # Walk the indented lines following 'esphome:' in place and stop at 'name:'
+    for lm in _LINE_RE.finditer(yaml_text, m.end()):
+        line = lm.group(0)
         if line.strip() == "":
-            block.append(line)
             continue
         if not line.startswith(" "):
             break  # Next top-level section
-        block.append(line)
-    
-    # Find 'name:' within the block
-    for line in block:
         m2 = NAME_LINE_RE.match(line)
         if m2:
             return m2.group(1).strip()
@@ -241,67 +774,374 @@ def parse_address(
     node: str
 ) -> Optional[str]:
     """Extract the address for the node from the YAML"""
+    ip = None
+    domain = None
 
-    # use_address
-    m_use_address = re.search(r"use_address:\s*(.*)", text)
-    if m_use_address:
-        address = m_use_address.group(1).strip()
-        return address
-
-    # IP address
-    m_ip = re.search(r"manual_ip\s*:\s*(\d{1,3}(?:\.\d{1,3}){3})", text)
-    if m_ip:
-        ip = m_ip.group(1).strip()
-        return ip
+    for m in ADDRESS_RE.finditer(text):
+        # use_address always wins
+        if m.group("use_address") is not None:
+            return m.group("use_address").strip()
+        if ip is None and m.group("ip") is not None:
+            ip = m.group("ip").strip()
+        elif domain is None and m.group("domain") is not None:
+            domain = f"{node}{m.group('domain').strip()}"
 
-    # domain
-    m_domain = re.search(r"domain:\s*(.+)", text)
-    if m_domain:
-        domain = f"{node}{m_domain.group(1).strip()}"
-        return domain
+    return ip or domain
 
-    return None
+def parse_update_hints(text: str) -> Tuple[int, List[str]]:
+    """
+    Extract the update_priority / update_depends_on substitutions
+    Returns: (priority, names of devices this one connects through)
+    """
+    m = PRIORITY_RE.search(text)
+    priority = int(m.group(1)) if m else 0
+    
+    depends_on = []
+    m = DEPENDS_ON_RE.search(text)
+    if m:
+        value = m.group(1).split(" #")[0].strip().strip("'\"[]")
+        depends_on = [n.strip().strip("'\"") for n in value.split(",") if n.strip()]
+    
+    return (priority, depends_on)
 
 
 # ============================================================================
 # DEVICE DISCOVERY
 # ============================================================================
 
-def discover_devices(container: str) -> List[dict]:
-    """Discover all ESPHome device configurations"""
+def list_device_configs() -> List[Path]:
+    """List device YAML files (excluding secrets.yaml), sorted by name"""
+    configs = []
+    with os.scandir(ESPHOME_CONFIG_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".yaml") or entry.name == "secrets.yaml":
+                continue
+            if entry.is_file():
+                configs.append(entry.name)
+    return [ESPHOME_CONFIG_DIR / name for name in sorted(configs)]
+
+DISCOVERY_WORKERS = 2  # Each is a full `esphome config` Python process
+
+def _shared_config_signature(container: str, device_files: List[Path]) -> str:
+    """
+    Fingerprint of what can change any device's `esphome config` output
+    apart from the top-level YAML files: the ESPHome version plus every
+    other YAML file under the config directory (secrets, packages, includes)
+    """
+    device_names = {f.name for f in device_files}
+    entries = [get_current_esphome_version(container)]
+    for root, dirs, files in os.walk(ESPHOME_CONFIG_DIR):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "builds")
+        top = root == str(ESPHOME_CONFIG_DIR)
+        for name in sorted(files):
+            if not name.endswith((".yaml", ".yml")) or (top and name in device_names):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append(f"{path}:{st.st_mtime_ns}:{st.st_size}")
+    return hashlib.sha256("\n".join(entries).encode("utf-8")).hexdigest()
+
+def _discovery_keys(signature: str, stats: Dict[str, Dict]) -> Dict[str, str]:
+    """
+    Discovery cache key per top-level file: the shared signature plus the
+    stats of every other top-level YAML file, since any of them may be a
+    package or include rather than a device
+    """
+    lines = {name: f"{name}:{st['mtime']}:{st['size']}\n".encode("utf-8") for name, st in stats.items()}
+    keys = {}
+    for name in lines:
+        digest = hashlib.sha256(signature.encode("utf-8"))
+        for other, line in lines.items():
+            if other != name:
+                digest.update(line)
+        keys[name] = digest.hexdigest()
+    return keys
+
+def _parse_device_config(text: str, yaml_file: Path) -> Dict:
+    """Device fields extracted from `esphome config` output (cacheable part)"""
+    # Extract node name
+    node = parse_node_name(text) or yaml_file.stem
+
+    # Extract the address
+    address = parse_address(text, node)
+    
+    priority, depends_on = parse_update_hints(text)
+    
+    return {
+        "node": node,
+        "address": address,
+        "priority": priority,
+        "depends_on": depends_on,
+        # Fully resolved config (packages and !include merged in)
+        "config_hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+    }
+
+def discover_devices(container: str, workers: int = DISCOVERY_WORKERS) -> List[dict]:
+    """
+    Discover all ESPHome device configurations, validating up to `workers`
+    changed files at once
+    """
     out = []
     
     if not ESPHOME_CONFIG_DIR.exists():
         log(f"ERROR: ESPHome config directory not found: {ESPHOME_CONFIG_DIR}")
         return out
     
-    for yaml_file in sorted(ESPHOME_CONFIG_DIR.glob("*.yaml")):
-        # Ignore secrets.yaml
-        if Path(yaml_file).stem == "secrets":
+    # Reuse parsed results for files unchanged since the last run, as long as
+    # nothing they could include (and the ESPHome version) changed either
+    yaml_files = list_device_configs()
+    signature = _shared_config_signature(container, yaml_files)
+    cached_files = load_json(DISCOVER_CACHE_FILE, {}).get("files", {})
+    
+    stats = {}
+    for yaml_file in yaml_files:
+        try:
+            st = yaml_file.stat()
+        except OSError:
             continue
-
-        # Get the complete, parsed configuration from the `esphome config` command.
-        rc, text = docker_exec(container, ["esphome", "config", yaml_file], capture=True)
+        stats[yaml_file.name] = {"mtime": st.st_mtime_ns, "size": st.st_size}
+    keys = _discovery_keys(signature, stats)
+    
+    parsed = {}
+    for name, st in stats.items():
+        entry = cached_files.get(name)
+        if entry and entry.get("key") == keys[name] and all(entry.get(k) == v for k, v in st.items()):
+            parsed[name] = entry["parsed"]
+    
+    # Get the complete, parsed configuration from the `esphome config` command.
+    # Validation is latency-bound, so run several at once; results keep file order.
+    to_validate = [f for f in yaml_files if f.name in stats and f.name not in parsed]
+    if parsed:
+        log(f"Discovery cache: {len(parsed)} unchanged, {len(to_validate)} to validate")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(
+            lambda f: docker_exec(container, ["esphome", "config", str(f)], capture=True),
+            to_validate
+        )
+        configs = list(zip(to_validate, results))
+    
+    for yaml_file, (rc, text) in configs:
         if rc != 0:
             log(f"✗  Validation error: {yaml_file}")
             log(textwrap.indent(text, '    '))
-            continue
-        
-        # Extract node name
-        node = parse_node_name(text) or yaml_file.stem
-
-        # Extract the address
-        address = parse_address(text, node)
-
-        out.append({
-            "name": yaml_file.stem,
-            "node": node,
-            "config": yaml_file.name,
-            "address": address,
+            continue  # Not cached: validated again next run
+        parsed[yaml_file.name] = _parse_device_config(text, yaml_file)
+    
+    for yaml_file in yaml_files:
+        fields = parsed.get(yaml_file.name)
+        if fields is not None:
+            out.append({"name": yaml_file.stem, "config": yaml_file.name, **fields})
+    
+    # Only files that still exist and validated; stale entries drop out
+    if not STOP_EVENT.is_set():
+        save_json_fast(DISCOVER_CACHE_FILE, {
+            "files": {
+                name: {**stats[name], "key": keys[name], "parsed": fields}
+                for name, fields in parsed.items()
+            },
         })
     
     return out
 
+# ============================================================================
+# DOCKER ENGINE API
+# ============================================================================
+
+DOCKER_SOCKETS     = ("/run/docker.sock", "/var/run/docker.sock")
+DOCKER_API_TIMEOUT = 30
+COPY_BUFFER_SIZE   = 1 << 20
+
+class DockerAPIError(Exception):
+    """Unexpected response from the Docker Engine API"""
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to the Docker daemon over its Unix socket"""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class _DockerClient:
+    """
+    Minimal Docker Engine API client
+    Short requests share one keep-alive connection per thread; output
+    streams (exec, archive) get a dedicated connection each.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _conn(self) -> _UnixHTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _UnixHTTPConnection(self.socket_path, timeout=DOCKER_API_TIMEOUT)
+            self._local.conn = conn
+        return conn
+
+    def _drop_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def request(self, method: str, path: str, body=None) -> Tuple[int, bytes]:
+        """Send a short request; returns (status, body)"""
+        payload = json_dumps(body, compact=True) if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+
+        # The daemon may have closed an idle keep-alive connection; retry once
+        for attempt in range(2):
+            try:
+                conn = self._conn()
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                if resp.will_close:
+                    self._drop_conn()
+                return (resp.status, data)
+            except (http.client.HTTPException, OSError):
+                self._drop_conn()
+                if attempt:
+                    raise
+
+    def stream(
+        self, method: str, path: str, body=None
+    ) -> Tuple[_UnixHTTPConnection, socket.socket, http.client.HTTPResponse]:
+        """
+        Send a request whose response is read incrementally by the caller
+        Returns: (connection, its socket, response); getresponse() drops
+                 conn.sock for responses without a length, such as exec
+                 streams, so the socket is taken before it
+        """
+        payload = json_dumps(body, compact=True) if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        conn = _UnixHTTPConnection(self.socket_path, timeout=None)
+        conn.request(method, path, body=payload, headers=headers)
+        sock = conn.sock
+        return (conn, sock, conn.getresponse())
+
+    def list_containers(self) -> List[str]:
+        """Names of all containers (running or not)"""
+        status, data = self.request("GET", "/containers/json?all=1")
+        if status != 200:
+            raise DockerAPIError(f"list containers: HTTP {status}")
+        return [n.lstrip("/") for c in json_loads(data) for n in (c.get("Names") or [])]
+
+    def inspect_container(self, container: str) -> Optional[Dict]:
+        """Container details, or None if it does not exist"""
+        status, data = self.request("GET", f"/containers/{urllib.parse.quote(container)}/json")
+        if status == 404:
+            return None
+        if status != 200:
+            raise DockerAPIError(f"inspect {container}: HTTP {status}")
+        return json_loads(data)
+
+    def exec_run(self, container: str, cmd: List[str], on_line) -> int:
+        """Run cmd in container, passing each output line to on_line; returns exit code"""
+        status, data = self.request(
+            "POST",
+            f"/containers/{urllib.parse.quote(container)}/exec",
+            {"Cmd": cmd, "AttachStdout": True, "AttachStderr": True, "Tty": False}
+        )
+        if status != 201:
+            raise DockerAPIError(f"exec in {container}: HTTP {status} {data[:200]!r}")
+        exec_id = json_loads(data)["Id"]
+
+        conn, sock, resp = self.stream("POST", f"/exec/{exec_id}/start", {"Detach": False, "Tty": False})
+        CURRENT_STREAMS.add(sock)
+        try:
+            # A stop that arrived before the socket was registered
+            if STOP_EVENT.is_set():
+                sock.shutdown(socket.SHUT_RDWR)
+            if resp.status != 200:
+                raise DockerAPIError(f"exec start: HTTP {resp.status}")
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            pending = ""
+            # Multiplexed stream: 8-byte header (stream id, 3 pad, big-endian size)
+            while True:
+                header = resp.read(8)
+                if len(header) < 8:
+                    break
+                size = struct.unpack(">I", header[4:])[0]
+                pending += decoder.decode(resp.read(size))
+                *complete, pending = pending.split("\n")
+                for line in complete:
+                    on_line(line + "\n")
+            pending += decoder.decode(b"", final=True)
+            if pending:
+                on_line(pending)
+        finally:
+            CURRENT_STREAMS.discard(sock)
+            conn.close()
+
+        # The stream ends when the process exits; the exit code may lag slightly
+        for _ in range(20):
+            status, data = self.request("GET", f"/exec/{exec_id}/json")
+            if status != 200:
+                raise DockerAPIError(f"exec inspect: HTTP {status}")
+            info = json_loads(data)
+            if not info.get("Running"):
+                return info.get("ExitCode") if info.get("ExitCode") is not None else 1
+            if STOP_EVENT.wait(0.1):
+                return 143
+        return 1
+
+    def get_file(self, container: str, src_path: str, dst_path: str):
+        """
+        Copy a single file out of a container via the archive endpoint
+        The tar stream is read once, straight into the destination; no CLI,
+        no staging copy. A partial file never replaces an existing one.
+        """
+        query = urllib.parse.urlencode({"path": src_path})
+        conn, _, resp = self.stream("GET", f"/containers/{urllib.parse.quote(container)}/archive?{query}")
+        try:
+            if resp.status != 200:
+                raise DockerAPIError(f"archive {container}:{src_path}: HTTP {resp.status}")
+            with tarfile.open(fileobj=resp, mode="r|", bufsize=COPY_BUFFER_SIZE) as tar:
+                for member in tar:
+                    if member.isfile():
+                        tmp_path = f"{dst_path}.part"
+                        try:
+                            with open(tmp_path, "wb") as out:
+                                shutil.copyfileobj(tar.extractfile(member), out, COPY_BUFFER_SIZE)
+                            os.replace(tmp_path, dst_path)
+                        finally:
+                            if os.path.exists(tmp_path):
+                                os.unlink(tmp_path)
+                        return
+            raise DockerAPIError(f"archive {container}:{src_path}: no regular file")
+        finally:
+            conn.close()
+
+_DOCKER_CLIENT: Optional[_DockerClient] = None
+
+def docker_api() -> Optional[_DockerClient]:
+    """Docker API client for the local socket, or None to use the docker CLI"""
+    global _DOCKER_CLIENT
+    if _DOCKER_CLIENT is None:
+        host = os.environ.get("DOCKER_HOST", "")
+        if host.startswith("unix://"):
+            candidates = (host[len("unix://"):],)
+        elif host:
+            return None  # Remote daemon: leave it to the CLI
+        else:
+            candidates = DOCKER_SOCKETS
+        for path in candidates:
+            if os.path.exists(path):
+                _DOCKER_CLIENT = _DockerClient(path)
+                break
+    return _DOCKER_CLIENT
+
 # ============================================================================
 # DOCKER OPERATIONS
 # ============================================================================
@@ -310,68 +1150,103 @@ def _run(
     cmd: list[str],
     env: Optional[dict] = None,
     capture: bool = False,
-    text_out: bool = True
+    on_line: Optional[Callable[[str], None]] = None
 ) -> Tuple[int, str]:
-    """Run subprocess with stop handling"""
-    global CURRENT_CHILD
-    
-    if STOP_REQUESTED:
+    """
+    Run subprocess with stop handling
+    Output is read line by line: returned when capture=True, logged otherwise,
+    or handed to on_line when given (nothing is then kept here).
+    env holds extra variables for the child; None inherits ours unchanged
+    """
+    if STOP_EVENT.is_set():
         return (143, "")
     
-    out = ""  # Initialize out variable
+    if env:
+        env = {**os.environ, **env}
+    
+    lines = []
+    sink = on_line or (lines.append if capture else (lambda line: log(line.rstrip())))
+    p = None
     
     try:
-        if capture:
-            p = subprocess.Popen(
-                cmd,
-                env=env,
-                preexec_fn=os.setsid,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=text_out
-            )
-        else:
-            p = subprocess.Popen(
-                cmd,
-                env=env,
-                preexec_fn=os.setsid
-            )
-        
-        CURRENT_CHILD = p
+        # start_new_session instead of preexec_fn=os.setsid: safe with threads
+        p = subprocess.Popen(
+            cmd,
+            env=env,
+            start_new_session=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1
+        )
+        CURRENT_CHILDREN.add(p)
         
-        if capture:
-            out = p.communicate()[0] or ""
-            rc = p.returncode
-        else:
-            rc = p.wait()
+        for line in p.stdout:
+            sink(line)
         
-        return (rc, out)
+        rc = p.wait()
+        return (rc, "".join(lines))
     finally:
-        CURRENT_CHILD = None
+        if p is not None:
+            if p.stdout:
+                p.stdout.close()
+            CURRENT_CHILDREN.discard(p)
 
 def docker_exec(
     container: str,
     args: list[str],
-    capture: bool = False
+    capture: bool = False,
+    on_line: Optional[Callable[[str], None]] = None
 ) -> Tuple[int, str]:
-    """Execute command inside Docker container"""
-    return _run(
-        ["docker", "exec", container] + args,
-        os.environ.copy(),
-        capture=capture
-    )
+    """Execute command inside Docker container (output handled as in _run)"""
+    api = docker_api()
+    if api is None:
+        return _run(
+            ["docker", "exec", container] + [str(a) for a in args],
+            capture=capture,
+            on_line=on_line
+        )
+    
+    if STOP_EVENT.is_set():
+        return (143, "")
+    
+    lines = []
+    sink = on_line or (lines.append if capture else (lambda line: log(line.rstrip())))
+    try:
+        rc = api.exec_run(container, [str(a) for a in args], sink)
+    except (DockerAPIError, http.client.HTTPException, OSError) as e:
+        if STOP_EVENT.is_set():
+            return (143, "".join(lines))
+        sink(f"Docker API error: {e}\n")
+        return (1, "".join(lines))
+    return (rc, "".join(lines))
 
 def docker_cp(src_container: str, src_path: str, dst_path: str) -> int:
     """Copy file from Docker container to host"""
-    rc, _ = _run(
-        ["docker", "cp", f"{src_container}:{src_path}", dst_path],
-        os.environ.copy(),
-        capture=False
-    )
-    return rc
+    api = docker_api()
+    if api is None:
+        rc, _ = _run(["docker", "cp", f"{src_container}:{src_path}", dst_path])
+        return rc
+    
+    try:
+        api.get_file(src_container, src_path, dst_path)
+        return 0
+    except (DockerAPIError, tarfile.TarError, http.client.HTTPException, OSError) as e:
+        log(f"Warning: copy of {src_container}:{src_path} failed: {e}")
+        return 1
 
 def container_exists(container: str) -> bool:
     """Check if Docker container exists"""
+    # Names already listed by verify_docker_connection(); IDs still need inspect
+    if _KNOWN_CONTAINERS and container in _KNOWN_CONTAINERS:
+        return True
+    api = docker_api()
+    if api is not None:
+        try:
+            return api.inspect_container(container) is not None
+        except Exception:
+            return False
     try:
         result = subprocess.run(
             ["docker", "inspect", container],
@@ -383,8 +1258,30 @@ def container_exists(container: str) -> bool:
     except Exception:
         return False
 
+@functools.lru_cache(maxsize=4)
+def get_container_image(container: str) -> str:
+    """Image ID the container runs (cached per container); "" if unknown"""
+    api = docker_api()
+    if api is not None:
+        try:
+            info = api.inspect_container(container) or {}
+            return info.get("Image") or ""
+        except Exception:
+            return ""
+    try:
+        result = subprocess.run(
+            ["docker", "inspect", "--format", "{{.Image}}", container],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=5
+        )
+        return result.stdout.decode().strip() if result.returncode == 0 else ""
+    except Exception:
+        return ""
+
+@functools.lru_cache(maxsize=4)
 def get_current_esphome_version(container: str) -> str:
-    """Get ESPHome version from container"""
+    """Get ESPHome version from container (cached per container)"""
     rc, out = docker_exec(container, ["esphome", "version"], capture=True)
     if rc == 0:
         m = re.search(r"(?:ESPHome|Version:)\s+([0-9][^\s]*)", out)
@@ -396,21 +1293,130 @@ def get_current_esphome_version(container: str) -> str:
 # VERSION TRACKING
 # ============================================================================
 
-def read_dashboard_versions(device_name: str) -> Tuple[Optional[str], Optional[str]]:
-    """Read deployed and current versions from ESPHome dashboard.json"""
-    if not DASHBOARD_JSON.exists():
-        return (None, None)
-    
+_DASHBOARD_CACHE = {"stat": None, "data": {}, "watched": False, "fresh": False}
+
+# inotify(7) constants
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_IGNORED     = 0x00008000
+IN_CLOEXEC     = 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+def invalidate_dashboard_cache():
+    """Force the next dashboard.json read to hit the disk"""
+    _DASHBOARD_CACHE["fresh"] = False
+    _DASHBOARD_CACHE["stat"] = None
+    _DASHBOARD_CACHE["data"] = {}
+
+def _watch_dashboard(fd: int):
+    """Mark the cached dashboard stale whenever ESPHome rewrites it"""
+    name = DASHBOARD_JSON.name.encode()
+    try:
+        while True:
+            buf = os.read(fd, 4096)
+            offset = 0
+            while offset + _INOTIFY_EVENT.size <= len(buf):
+                _, mask, _, length = _INOTIFY_EVENT.unpack_from(buf, offset)
+                start = offset + _INOTIFY_EVENT.size
+                offset = start + length
+                if mask & IN_IGNORED:
+                    return  # Watch removed (directory gone)
+                if buf[start:offset].rstrip(b"\0") == name:
+                    _DASHBOARD_CACHE["fresh"] = False
+    except OSError:
+        pass
+    finally:
+        # Back to stat-based validation
+        _DASHBOARD_CACHE["watched"] = False
+        _DASHBOARD_CACHE["fresh"] = False
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def start_dashboard_watcher() -> bool:
+    """
+    Watch dashboard.json with inotify so cached reads need no stat() call
+    Returns False (stat-based caching stays in use) where inotify is unavailable
+    """
+    if _DASHBOARD_CACHE["watched"]:
+        return True
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(ESPHOME_CONFIG_DIR), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, "inotify_add_watch failed")
+    except (OSError, AttributeError):
+        return False
+
+    invalidate_dashboard_cache()
+    _DASHBOARD_CACHE["watched"] = True
+    threading.Thread(target=_watch_dashboard, args=(fd,), name="dashboard-watch", daemon=True).start()
+    return True
+
+def _read_dashboard_file() -> Dict:
+    """Read and parse dashboard.json ({} if missing or invalid)"""
     try:
-        dashboard = json.loads(DASHBOARD_JSON.read_text(encoding="utf-8"))
-        device_info = dashboard.get(device_name, {})
-        deployed = device_info.get("deployed_version")
-        current = device_info.get("current_version")
-        return (deployed, current)
+        data = json_loads(DASHBOARD_JSON.read_bytes())
     except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def load_dashboard() -> Dict:
+    """Load ESPHome dashboard.json, reusing the parsed copy while unchanged"""
+    if _DASHBOARD_CACHE["watched"]:
+        if _DASHBOARD_CACHE["fresh"]:
+            return _DASHBOARD_CACHE["data"]
+        # Mark fresh before reading: an event during the read clears it again
+        _DASHBOARD_CACHE["fresh"] = True
+        _DASHBOARD_CACHE["data"] = _read_dashboard_file()
+        return _DASHBOARD_CACHE["data"]
+
+    try:
+        st = DASHBOARD_JSON.stat()
+    except OSError:
+        invalidate_dashboard_cache()
+        return {}
+
+    key = (st.st_mtime_ns, st.st_size)
+    if _DASHBOARD_CACHE["stat"] == key:
+        return _DASHBOARD_CACHE["data"]
+
+    data = _read_dashboard_file()
+    _DASHBOARD_CACHE["stat"] = key
+    _DASHBOARD_CACHE["data"] = data
+    return data
+
+def read_dashboard_versions(device_name: str) -> Tuple[Optional[str], Optional[str]]:
+    """Read deployed and current versions from ESPHome dashboard.json"""
+    device_info = load_dashboard().get(device_name) or {}
+    if not isinstance(device_info, dict):
         return (None, None)
+    return (device_info.get("deployed_version"), device_info.get("current_version"))
+
+def _load_all_versions() -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    """Build a {device_name: (deployed, current)} map from dashboard.json"""
+    versions = {}
+    for name, info in load_dashboard().items():
+        if isinstance(info, dict):
+            versions[name] = (info.get("deployed_version"), info.get("current_version"))
+    return versions
 
-def needs_update(device_name: str, progress: Dict) -> Tuple[bool, str]:
+def needs_update(
+    device_name: str,
+    progress: Dict,
+    versions_map: Optional[Dict[str, Tuple[Optional[str], Optional[str]]]] = None,
+    force: bool = False
+) -> Tuple[bool, str]:
     """
     Determine if device needs update
     Returns: (needs_update, reason)
@@ -418,10 +1424,16 @@ def needs_update(device_name: str, progress: Dict) -> Tuple[bool, str]:
     # Already done this run
     if device_name in progress.get("done", []):
         return (False, "already updated this run")
-    
-    # Read versions from dashboard
-    deployed, current = read_dashboard_versions(device_name)
-    
+
+    if force:
+        return (True, "force_update enabled")
+
+    # Read versions from the preloaded map, or from dashboard
+    if versions_map is not None:
+        deployed, current = versions_map.get(device_name, (None, None))
+    else:
+        deployed, current = read_dashboard_versions(device_name)
+
     if deployed is None or current is None:
         return (True, "version information unavailable")
     
@@ -434,60 +1446,162 @@ def needs_update(device_name: str, progress: Dict) -> Tuple[bool, str]:
 # COMPILATION
 # ============================================================================
 
-def compile_in_esphome_container(
+COMPILE_CACHE_MAX_AGE = 7 * 24 * 3600  # seconds
+
+_COMPILE_CACHE: Optional[Dict] = None
+_COMPILE_CACHE_LOCK = threading.Lock()
+
+def _compile_cache() -> Dict:
+    """Load the compile cache once, dropping expired entries (lock held)"""
+    global _COMPILE_CACHE
+    if _COMPILE_CACHE is None:
+        cache = load_json(COMPILE_CACHE_FILE, {})
+        if not isinstance(cache, dict):
+            cache = {}
+        cutoff = time.time() - COMPILE_CACHE_MAX_AGE
+        _COMPILE_CACHE = {
+            name: entry for name, entry in cache.items()
+            if isinstance(entry, dict) and entry.get("mtime", 0) >= cutoff
+        }
+    return _COMPILE_CACHE
+
+def compile_cache_key(dev: dict, container: str) -> Optional[str]:
+    """Hash of everything that determines the firmware; None if unknown"""
+    config_hash = dev.get("config_hash")
+    version = get_current_esphome_version(container)
+    image = get_container_image(container)
+    if not config_hash or version == "unknown" or not image:
+        return None
+    return hashlib.sha256(f"{config_hash}\0{version}\0{image}".encode("utf-8")).hexdigest()
+
+def _file_sha256(path: str) -> Optional[str]:
+    """SHA-256 of a file's contents, or None if it cannot be read"""
+    try:
+        with open(path, "rb") as fh:
+            return hashlib.file_digest(fh, "sha256").hexdigest()
+    except OSError:
+        return None
+
+def cached_binary(device_name: str, key: Optional[str]) -> Optional[str]:
+    """
+    Binary from an earlier compile of the identical config, if it is still
+    on disk unchanged
+    """
+    if key is None:
+        return None
+    with _COMPILE_CACHE_LOCK:
+        entry = _compile_cache().get(device_name)
+    if not entry or entry.get("hash") != key:
+        return None
+    bin_path = entry.get("bin_path")
+    if not bin_path or _file_sha256(bin_path) != entry.get("sha256"):
+        return None
+    return bin_path
+
+def record_compiled_binary(device_name: str, key: Optional[str], bin_path: str):
+    """Remember a successful compile for reuse by later runs"""
+    if key is None:
+        return
+    digest = _file_sha256(bin_path)
+    if digest is None:
+        return
+    with _COMPILE_CACHE_LOCK:
+        cache = _compile_cache()
+        cache[device_name] = {
+            "hash": key,
+            "bin_path": bin_path,
+            "sha256": digest,
+            "mtime": time.time(),
+        }
+        save_json_fast(COMPILE_CACHE_FILE, cache)
+
+def forget_compiled_binary(device_name: str):
+    """Drop a cache entry, so the next attempt compiles again"""
+    with _COMPILE_CACHE_LOCK:
+        cache = _compile_cache()
+        if cache.pop(device_name, None) is not None:
+            save_json_fast(COMPILE_CACHE_FILE, cache)
+
+def container_config_path(host_path: str) -> str:
+    """Path of a file under the ESPHome config dir as the ESPHome add-on sees it"""
+    return f"/config/esphome/{Path(host_path).relative_to(ESPHOME_CONFIG_DIR).as_posix()}"
+
+FIRMWARE_MARKER = "__FIRMWARE__="
+COMPILE_SUCCESS_MARKER = "Successfully compiled program"
+OTA_SUCCESS_MARKERS = ("OTA successful", "Successfully uploaded program")
+
+def compile_and_upload_in_esphome_container(
     container: str,
     yaml_name: str,
     device_name: str,
-    node: str
-) -> Optional[str]:
+    node: str,
+    target: str,
+    tail_lines: int = 40
+) -> Tuple[Optional[str], bool, Optional[str]]:
     """
-    Compile firmware in ESPHome container
-    Returns: Path to compiled binary on host, or None if failed
+    Compile and OTA-upload in one `esphome run`, then copy the binary out
+    Compile output is logged live; upload output is kept as a tail only.
+    A stop request only discards the result while still compiling; a
+    finished compile or upload is reported as it happened.
+    Returns: (path to compiled binary on host or None, upload succeeded,
+              last tail_lines lines of upload output or None if the
+              compile failed)
     """
-    log(f"→ Compiling {yaml_name} via Docker in '{container}'")
-    
-    rc, _ = docker_exec(
-        container,
-        ["esphome", "compile", f"/config/esphome/{yaml_name}"],
-        capture=False
-    )
-    
-    if rc != 0 or STOP_REQUESTED:
-        if STOP_REQUESTED:
-            log("Stop requested; aborting compile.")
-        else:
-            log(f"✗ Compilation failed for {device_name}")
-        return None
+    log(f"→ Compiling and uploading {yaml_name} via Docker in '{container}'")
     
-    # Locate compiled binary
-    stem = Path(yaml_name).stem
+    # Locate the binary (PlatformIO layout first, then legacy) in the same
+    # exec; the path comes back on a marker line
     pio_bin = f"/data/build/{node}*/.pioenvs/{node}*/firmware.bin"
     legacy = f"/config/esphome/.esphome/build/{node}/{node}.bin"
+    script = (
+        'esphome run "$1" --device "$2" --no-logs; rc=$?; '
+        f"bin=$(ls -1 {pio_bin} 2>/dev/null | head -n1); "
+        f'[ -n "$bin" ] || bin={legacy}; '
+        f'[ ! -f "$bin" ] || echo "{FIRMWARE_MARKER}$bin"; '
+        'exit $rc'
+    )
     
-    dst_dir = Path("/config/esphome/builds")
-    dst_dir.mkdir(parents=True, exist_ok=True)
-    dst = str(dst_dir / f"{stem}.bin")
+    found = []
+    tail = deque(maxlen=tail_lines)
+    compiled = False
+    uploaded = False
+    
+    def on_line(line: str):
+        nonlocal compiled, uploaded
+        if line.startswith(FIRMWARE_MARKER):
+            found.append(line[len(FIRMWARE_MARKER):].strip())
+        elif not compiled:
+            log(line.rstrip())
+            compiled = COMPILE_SUCCESS_MARKER in line
+        else:
+            tail.append(line)
+            uploaded = uploaded or any(m in line for m in OTA_SUCCESS_MARKERS)
     
-    # Try new PlatformIO path structure
-    rc, out = docker_exec(
+    rc, _ = docker_exec(
         container,
-        ["sh", "-lc", f"set -e; ls -1 {pio_bin} 2>/dev/null | head -n1"],
-        capture=True
+        ["sh", "-c", script, "sh", f"/config/esphome/{yaml_name}", target],
+        on_line=on_line
     )
     
-    if rc == 0 and out.strip():
-        src = out.strip().splitlines()[0].strip()
-        if docker_cp(container, src, dst) == 0:
-            log(f"→ Binary copied to {dst} (from {src})")
-            return dst
+    if not compiled:
+        if STOP_EVENT.is_set():
+            log("Stop requested; aborting compile.")
+            return (None, False, None)
+        log(f"✗ Compilation failed for {device_name}")
+        return (None, False, None)
     
-    # Fallback to legacy path
-    if docker_cp(container, legacy, dst) == 0:
-        log(f"→ Binary copied to {dst} (from {legacy})")
-        return dst
+    stem = Path(yaml_name).stem
+    BUILDS_DIR.mkdir(parents=True, exist_ok=True)
+    dst = str(BUILDS_DIR / f"{stem}.bin")
     
-    log(f"✗ Could not locate firmware binary for {device_name}")
-    return None
+    bin_path = None
+    if found and docker_cp(container, found[-1], dst) == 0:
+        log(f"→ Binary copied to {dst} (from {found[-1]})")
+        bin_path = dst
+    else:
+        log(f"⚠ Could not locate firmware binary for {device_name}")
+    
+    return (bin_path, rc == 0 or uploaded, "".join(tail))
 
 # ============================================================================
 # OTA UPLOAD
@@ -496,22 +1610,31 @@ def compile_in_esphome_container(
 def ota_upload_via_esphome(
     container: str,
     yaml_name: str,
-    target: str
+    target: str,
+    firmware: Optional[str] = None,
+    tail_lines: int = 40
 ) -> Tuple[bool, str]:
     """
     Upload firmware via OTA using ESPHome CLI
-    Returns: (success, output)
+    firmware is a binary (host path under the config dir) to flash instead
+    of whatever is in ESPHome's own build directory
+    Returns: (success, last tail_lines lines of output)
     """
-    args = ["esphome", "upload", f"/config/esphome/{yaml_name}", "--device", target]
-    rc, out = docker_exec(container, args, capture=True)
+    tail = deque(maxlen=tail_lines)
+    uploaded = False
     
-    success = (
-        rc == 0 or
-        "OTA successful" in out or
-        "Successfully uploaded program" in out
-    )
+    def on_line(line: str):
+        nonlocal uploaded
+        tail.append(line)
+        if any(m in line for m in OTA_SUCCESS_MARKERS):
+            uploaded = True
     
-    return (success, out)
+    args = ["esphome", "upload", f"/config/esphome/{yaml_name}", "--device", target]
+    if firmware:
+        args += ["--file", container_config_path(firmware)]
+    rc, _ = docker_exec(container, args, on_line=on_line)
+    
+    return (rc == 0 or uploaded, "".join(tail))
 
 # ============================================================================
 # SAFETY CHECKS
@@ -572,15 +1695,27 @@ def verify_docker_cli() -> bool:
     return False
 
 def verify_docker_connection() -> bool:
-    """Verify we can communicate with Docker daemon"""
+    """Verify we can communicate with Docker daemon (and remember container names)"""
+    global _KNOWN_CONTAINERS
+    api = docker_api()
+    if api is not None:
+        try:
+            _KNOWN_CONTAINERS = frozenset(api.list_containers())
+            log("✓ Docker daemon communication OK (Engine API)")
+            return True
+        except Exception as e:
+            log(f"✗ Docker daemon communication failed: {e}")
+            return False
+    
     try:
         result = subprocess.run(
-            ["docker", "ps"],
-            stdout=subprocess.DEVNULL,
+            ["docker", "ps", "-a", "--format", "{{.Names}}"],
+            stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             timeout=5
         )
         if result.returncode == 0:
+            _KNOWN_CONTAINERS = frozenset(result.stdout.decode().split())
             log("✓ Docker daemon communication OK")
             return True
         else:
@@ -637,7 +1772,7 @@ def verify_esphome_config_dir() -> bool:
         log("")
         return False
     
-    yaml_count = len(list(ESPHOME_CONFIG_DIR.glob("*.yaml")))
+    yaml_count = len(list_device_configs())
     log(f"✓ ESPHome config directory accessible")
     log(f"✓ Found {yaml_count} device configuration(s)")
     
@@ -675,49 +1810,57 @@ def verify_safe_operation() -> bool:
 def perform_housekeeping(opts: Dict, state: Dict, progress: Dict) -> Dict:
     """Handle log and progress file cleanup"""
     addon_version = os.environ.get("ADDON_VERSION", "unknown")
+    last_version = state.get("last_version")
+    clear_log_now = bool(opts.get("clear_log_now", False))
+    clear_log_now_consumed = bool(state.get("clear_log_now_consumed", False))
+    clear_progress_now = bool(opts.get("clear_progress_now", False))
+    clear_progress_now_consumed = bool(state.get("clear_progress_now_consumed", False))
+    state_dirty = False
+    progress_dirty = False
     
     # Version change detection
     if opts.get("always_clear_log_on_version_change", True):
-        if addon_version and addon_version != state.get("last_version"):
+        if addon_version and addon_version != last_version:
             truncate_file(LOG_FILE)
-            log(f"Add-on version changed: {state.get('last_version')} → {addon_version}")
+            log(f"Add-on version changed: {last_version} → {addon_version}")
             log("Log file cleared due to version change")
             state["last_version"] = addon_version
-            save_state(state)
+            state_dirty = True
     
     # Clear log on start
     if opts.get("clear_log_on_start", False):
         truncate_file(LOG_FILE)
         log("Log file cleared (clear_log_on_start)")
     
-    # Clear log now (one-time trigger)
-    if bool(opts.get("clear_log_now", False)) and not state.get("clear_log_now_consumed", False):
-        truncate_file(LOG_FILE)
-        log("Log file cleared (clear_log_now trigger)")
-        state["clear_log_now_consumed"] = True
-        save_state(state)
-    elif not bool(opts.get("clear_log_now", False)) and state.get("clear_log_now_consumed", False):
-        state["clear_log_now_consumed"] = False
-        save_state(state)
+    # Clear log now (one-time trigger; re-armed once the option is turned off)
+    if clear_log_now != clear_log_now_consumed:
+        if clear_log_now:
+            truncate_file(LOG_FILE)
+            log("Log file cleared (clear_log_now trigger)")
+        state["clear_log_now_consumed"] = clear_log_now
+        state_dirty = True
     
-    # Clear progress on start
-    if opts.get("clear_progress_on_start", False):
-        truncate_file(PROGRESS_FILE)
-        progress = {"done": [], "failed": [], "skipped": []}
-        save_progress(progress)
+    # Clear progress on start / now (one-time trigger)
+    clear_progress = opts.get("clear_progress_on_start", False)
+    if clear_progress:
         log("Progress file cleared (clear_progress_on_start)")
     
-    # Clear progress now (one-time trigger)
-    if bool(opts.get("clear_progress_now", False)) and not state.get("clear_progress_now_consumed", False):
-        truncate_file(PROGRESS_FILE)
-        progress = {"done": [], "failed": [], "skipped": []}
-        save_progress(progress)
-        log("Progress file cleared (clear_progress_now trigger)")
-        state["clear_progress_now_consumed"] = True
-        save_state(state)
-    elif not bool(opts.get("clear_progress_now", False)) and state.get("clear_progress_now_consumed", False):
-        state["clear_progress_now_consumed"] = False
+    if clear_progress_now != clear_progress_now_consumed:
+        if clear_progress_now:
+            clear_progress = True
+            log("Progress file cleared (clear_progress_now trigger)")
+        state["clear_progress_now_consumed"] = clear_progress_now
+        state_dirty = True
+    
+    if clear_progress:
+        progress = {"done": [], "failed": {}, "skipped": []}
+        progress_dirty = True
+    
+    # Write each file at most once
+    if state_dirty:
         save_state(state)
+    if progress_dirty:
+        save_progress(progress)
     
     return progress
 
@@ -759,18 +1902,34 @@ def filter_devices(
         else:
             log(f"WARNING: start_from_device '{start_from}' not found; processing all")
     
-    # Check which devices need updates
+    # Check which devices need updates (dashboard.json is loaded once)
+    versions_map = _load_all_versions()
+    force = opts.get("force_update", False)
+    if force:
+        log("force_update enabled: updating devices regardless of version")
+    done = set(progress.get("done", []))
+    now = time.time()
     filtered = []
     for dev in devices:
         name = dev["name"]
-        
+
         # Skip already processed
-        if name in progress.get("done", []):
+        if name in done:
             skip_reasons[name] = "already updated this run"
             continue
-        
+
+        # Failed recently: wait out its retry cooldown
+        wait = retry_wait(progress, name, now)
+        if wait > 0:
+            entry = progress["failed"][name]
+            skip_reasons[name] = (
+                f"retry in {int(wait // 60) + 1} min "
+                f"(attempt {entry['attempts']}: {entry.get('last_reason') or 'failed'})"
+            )
+            continue
+
         # Check if update needed
-        needs, reason = needs_update(name, progress)
+        needs, reason = needs_update(name, progress, versions_map, force)
         if not needs:
             skip_reasons[name] = reason
             continue
@@ -779,27 +1938,80 @@ def filter_devices(
     
     return (filtered, skip_reasons)
 
+def order_devices(devices: List[dict]) -> Tuple[List[dict], Dict[str, List[str]]]:
+    """
+    Update leaves before the routers/repeaters they connect through
+    (update_depends_on), lowest update_priority first within each level,
+    then those with a binary already in the builds directory. Ties keep
+    discovery order; the set of devices is unchanged.
+    Returns: (ordered devices, {router name: names of devices depending on
+              it}) - the dependencies actually applied, empty on a cycle
+    """
+    devices = sorted(devices, key=lambda dev: not (BUILDS_DIR / f"{dev['name']}.bin").exists())
+    
+    # A router goes after every device that depends on it (by name or node)
+    index = {}
+    for i, dev in enumerate(devices):
+        index.setdefault(dev["node"], i)
+        index[dev["name"]] = i
+    sorter = graphlib.TopologicalSorter({i: set() for i in range(len(devices))})
+    edges: Dict[str, List[str]] = {}
+    for i, dev in enumerate(devices):
+        for upstream in dev.get("depends_on", []):
+            j = index.get(upstream)
+            if j is not None and j != i:
+                sorter.add(j, i)
+                edges.setdefault(devices[j]["name"], []).append(dev["name"])
+    
+    try:
+        sorter.prepare()
+    except graphlib.CycleError as e:
+        names = [devices[i]["name"] for i in e.args[1]]
+        log(f"WARNING: update_depends_on cycle ({' → '.join(names)}); ignoring dependencies")
+        return (sorted(devices, key=lambda dev: dev.get("priority", 0)), {})
+    
+    ordered = []
+    while sorter.is_active():
+        ready = sorted(sorter.get_ready(), key=lambda i: (devices[i].get("priority", 0), i))
+        ordered.extend(devices[i] for i in ready)
+        sorter.done(*ready)
+    return (ordered, edges)
+
 # ============================================================================
 # MAIN UPDATE LOGIC
 # ============================================================================
 
-def update_device(
-    dev: dict,
-    opts: Dict,
-    progress: Dict,
+@dataclass(frozen=True, slots=True)
+class RunCtx:
+    """Settings for one run, resolved once from the add-on options"""
+    container: str
+    skip_offline: bool
     dry_run: bool
-) -> str:
+    delay: int
+    force: bool
+    max_parallel: int
+
+    @classmethod
+    def from_options(cls, opts: Dict) -> "RunCtx":
+        return cls(
+            container=opts["esphome_container"],
+            skip_offline=bool(opts.get("skip_offline", True)),
+            dry_run=bool(opts.get("dry_run", False)),
+            delay=max(0, int(opts.get("delay_between_updates", 3))),
+            force=bool(opts.get("force_update", False)),
+            max_parallel=max(1, int(opts.get("parallel_updates", 2))),
+        )
+
+def update_device(dev: dict, ctx: RunCtx) -> Tuple[str, str]:
     """
     Update a single device
-    Returns: status ("done", "failed", "skipped")
+    Returns: (status ("done", "failed", "skipped"), reason for a failure)
     """
     name = dev["name"]
     node = dev["node"]
     yaml_name = dev["config"]
     ip = dev["address"]
-    
-    container = opts["esphome_container"]
-    skip_offline = opts.get("skip_offline", True)
+    container = ctx.container
     
     log(f"Config: {yaml_name}")
     
@@ -807,51 +2019,133 @@ def update_device(
     deployed, current = read_dashboard_versions(name)
     log(f"Versions: deployed={deployed or 'unknown'}, current={current or 'unknown'}")
     
+    # The dashboard may have caught up since filtering (e.g. a manual install)
+    if deployed and current and deployed == current and not ctx.force:
+        log("✓ Already up to date; skipping")
+        return ("skipped", "")
+    
     # Determine target
-    target = ip if ip else f"{node}.local"
+    target = resolve_target(node, ip)
+    hostname = ip or f"{node}.local"
+    resolved = f" ({target})" if target != hostname else ""
     if not ip:
-        log(f"No manual IP configured; using mDNS: {target}")
-    
-    # Ping check
-    if skip_offline and ip:
-        if not ping_host(ip):
-            log(f"⚠ Device appears offline (ping failed); skipping")
-            return "skipped"
+        log(f"No manual IP configured; using mDNS: {hostname}{resolved}")
+    elif resolved:
+        log(f"Using mDNS: {hostname}{resolved}")
     
     # Dry run mode
-    if dry_run:
+    if ctx.dry_run:
         log("→ DRY RUN: Would compile and upload here")
-        return "done"
+        return ("done", "")
     
     # Real update
     log(f"→ Starting update for {name}")
     
-    # Compile
-    bin_path = compile_in_esphome_container(container, yaml_name, name, node)
-    if STOP_REQUESTED:
-        log("Stop requested during compile")
-        return "skipped"
-    
-    if not bin_path:
-        return "failed"
-    
-    # Upload
-    ok, out = ota_upload_via_esphome(container, yaml_name, target)
-    
+    # Upload only, if this exact config was already built by this ESPHome
+    # image; otherwise compile and upload in one `esphome run`
+    cache_key = compile_cache_key(dev, container)
+    bin_path = cached_binary(name, cache_key)
+    if bin_path:
+        log(f"→ Config unchanged since last compile; reusing {bin_path}")
+        ok, out = ota_upload_via_esphome(container, yaml_name, target, firmware=bin_path)
+        if not ok and not STOP_EVENT.is_set():
+            # Next attempt compiles again instead of repeating this upload
+            forget_compiled_binary(name)
+    else:
+        bin_path, ok, out = compile_and_upload_in_esphome_container(
+            container, yaml_name, name, node, target
+        )
+        if bin_path:
+            record_compiled_binary(name, cache_key, bin_path)
+        if out is None and STOP_EVENT.is_set():
+            log("Stop requested during compile")
+            return ("skipped", "")
+        if out is None:
+            return ("failed", "compilation failed")
+    invalidate_dashboard_cache()
+    
+    if not ok and STOP_EVENT.is_set():
+        # Interrupted, not failed; a recorded binary is reused next run
+        log("Stop requested during upload")
+        return ("skipped", "")
+
     if ok:
         log("→ OTA upload successful")
-        return "done"
+        return ("done", "")
     else:
-        # Log tail of output for debugging
-        tail = "\n".join(out.splitlines()[-40:])
-        log("OTA upload failed. Output (last 40 lines):")
-        for line in tail.splitlines():
-            log(f"  {line}")
+        # Log tail of output for debugging, as one entry
+        log("OTA upload failed. Output (last 40 lines):\n  " + "\n  ".join(out.splitlines()))
         log(f"✗ Update failed for {name}")
-        return "failed"
+        return ("failed", "OTA upload failed")
+
+class AdaptiveThrottle:
+    """
+    Concurrency and inter-device delay that back off when updates fail
+    A failure halves the active worker slots and doubles the delay (max
+    30s); RECOVER_AFTER successes in a row win back one slot and
+    halve the delay, down to the configured values.
+    """
+
+    MAX_DELAY = 30
+    RECOVER_AFTER = 5
+
+    def __init__(self, max_parallel: int, delay: int):
+        self.max_parallel = max(1, max_parallel)
+        self.base_delay = max(0, delay)
+        self.limit = self.max_parallel
+        self.delay = self.base_delay
+        self._active = 0
+        self._waiting: List[int] = []  # sorted queue positions
+        self._streak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, position: int) -> bool:
+        """
+        Wait for a free slot, granted in queue position order
+        Returns: False if a stop was requested meanwhile
+        """
+        with self._cond:
+            bisect.insort(self._waiting, position)
+            try:
+                while not STOP_EVENT.is_set():
+                    if self._active < self.limit and self._waiting[0] == position:
+                        self._active += 1
+                        return True
+                    self._cond.wait(1)
+                return False
+            finally:
+                self._waiting.remove(position)
+                self._cond.notify_all()
+
+    def release(self):
+        """Free a slot taken by acquire()"""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def record(self, status: str):
+        """Adjust limits from one device result ("skipped" is neutral)"""
+        with self._cond:
+            before = (self.limit, self.delay)
+            if status == "failed":
+                self._streak = 0
+                self.limit = max(1, self.limit // 2)
+                self.delay = min(self.MAX_DELAY, max(1, self.delay * 2))
+            elif status == "done":
+                self._streak += 1
+                if self._streak >= self.RECOVER_AFTER and before != (self.max_parallel, self.base_delay):
+                    self._streak = 0
+                    self.limit = min(self.max_parallel, self.limit + 1)
+                    self.delay = max(self.base_delay, self.delay // 2)
+            if (self.limit, self.delay) != before:
+                log(f"Throttle: {before[0]} → {self.limit} parallel, "
+                    f"{before[1]}s → {self.delay}s between updates")
+            self._cond.notify_all()
 
 def main():
     """Main execution function"""
+    start_log_writer()
+    
     # Load configuration
     opts = load_options()
     state = load_state()
@@ -859,6 +2153,7 @@ def main():
     
     # Housekeeping
     progress = perform_housekeeping(opts, state, progress)
+    ctx = RunCtx.from_options(opts)
     
     # Safety checks
     if not verify_safe_operation():
@@ -867,7 +2162,7 @@ def main():
         sys.exit(1)
     
     # Verify ESPHome container
-    esphome_container = opts["esphome_container"]
+    esphome_container = ctx.container
     if not verify_esphome_container(esphome_container):
         sys.exit(1)
     
@@ -886,13 +2181,13 @@ def main():
     # Start main process
     log_header("ESPHome Selective Updates v2.0")
     
-    dry_run = opts.get("dry_run", False)
-    if dry_run:
+    if ctx.dry_run:
         log("⚠ DRY RUN MODE - No actual updates will be performed")
     
     # Discover devices
     log_section("Device Discovery")
-    devices = discover_devices(esphome_container)
+    # Validate as many configs at once as the user allows compiles
+    devices = discover_devices(esphome_container, workers=ctx.max_parallel)
     total = len(devices)
     log(f"Found {total} total device configuration(s)")
     
@@ -902,6 +2197,7 @@ def main():
     
     # Filter devices
     log_section("Filtering Devices")
+    start_dashboard_watcher()
     filtered_devices, skip_reasons = filter_devices(devices, opts, progress)
     
     log(f"Devices needing update: {len(filtered_devices)}")
@@ -913,6 +2209,20 @@ def main():
         for name, reason in sorted(skip_reasons.items()):
             log(f"  • {name}: {reason}")
     
+    # Ping all targets up front; offline devices never enter the queue
+    reachable = ping_phase(filtered_devices, ctx.skip_offline)
+    offline = [d for d in filtered_devices if d["address"] and d["address"] not in reachable]
+    if offline:
+        log("")
+        for dev in offline:
+            log(f"⊘ {dev['name']} appears offline (ping failed); skipping")
+            append_progress_event(progress, dev["name"], "skipped")
+        filtered_devices = [d for d in filtered_devices if d not in offline]
+    
+    # Leaves before their routers, then likely-to-succeed devices first, so
+    # a cap or an early stop wastes less
+    filtered_devices, depends = order_devices(filtered_devices)
+    
     # Apply max_devices_per_run limit
     max_devices = opts.get("max_devices_per_run", 0)
     if max_devices > 0 and len(filtered_devices) > max_devices:
@@ -929,69 +2239,106 @@ def main():
     # Process devices
     log_header(f"Processing {to_process} Device(s)")
     
-    done = set(progress.get("done", []))
-    failed = set(progress.get("failed", []))
-    skipped = set(progress.get("skipped", []))
-    
-    delay = int(opts.get("delay_between_updates", 3))
+    parallel = min(ctx.max_parallel, to_process)
+    if parallel > 1:
+        log(f"Updating up to {parallel} devices in parallel")
+    
+    progress_lock = threading.Lock()
+    started = [0]
+    throttle = AdaptiveThrottle(parallel, ctx.delay)
+    
+    # A router waits for the devices connecting through it to finish; only
+    # those queued ahead of it, which always get a worker first
+    finished = {dev["name"]: threading.Event() for dev in filtered_devices}
+    position = {dev["name"]: i for i, dev in enumerate(filtered_devices)}
+    dependents: Dict[str, List[threading.Event]] = {
+        upstream: [
+            finished[name] for name in names
+            if name in position and position[name] < position[upstream]
+        ]
+        for upstream, names in depends.items() if upstream in position
+    }
+    
+    def process(idx: int, dev: dict):
+        name = dev["name"]
+        try:
+            for event in dependents.get(name, []):
+                while not event.wait(1):
+                    if STOP_EVENT.is_set():
+                        return
+            if not throttle.acquire(idx):
+                return
+            try:
+                _process(idx, dev)
+            finally:
+                throttle.release()
+        finally:
+            finished[name].set()
     
-    for idx, dev in enumerate(filtered_devices, start=1):
-        if STOP_REQUESTED:
-            log("")
-            log("⚠ Stop requested; saving progress and exiting")
-            break
-        
+    def _process(idx: int, dev: dict):
         name = dev["name"]
+        with progress_lock:
+            started[0] += 1
         
-        log("")
-        log(f"[{idx}/{to_process}] Processing: {name}")
-        
-        status = update_device(dev, opts, progress, dry_run)
-        
-        # Update progress
-        if status == "done":
-            done.add(name)
-            failed.discard(name)
-            log(f"✓ {name} completed successfully")
-        elif status == "failed":
-            failed.add(name)
-            log(f"✗ {name} failed")
-        elif status == "skipped":
-            skipped.add(name)
-            log(f"⊘ {name} skipped")
-        
-        # Save progress
-        progress["done"] = sorted(list(done))
-        progress["failed"] = sorted(list(failed))
-        progress["skipped"] = sorted(list(skipped))
-        save_progress(progress)
-        
-        # Delay between devices
-        if idx < to_process:  # Don't delay after last device
-            for _ in range(max(0, delay)):
-                if STOP_REQUESTED:
-                    break
-                time.sleep(1)
-        
-        if STOP_REQUESTED:
+        _LOG_CONTEXT.prefix = f"[{name}] " if parallel > 1 else ""
+        try:
             log("")
-            log("⚠ Stop requested after device processing")
-            break
+            log(f"[{idx}/{to_process}] Processing: {name}")
+            
+            status, reason = update_device(dev, ctx)
+            
+            # Update progress
+            with progress_lock:
+                if status == "done":
+                    log(f"✓ {name} completed successfully")
+                elif status == "failed":
+                    log(f"✗ {name} failed")
+                elif status == "skipped":
+                    log(f"⊘ {name} skipped")
+                
+                append_progress_event(progress, name, status, reason)
+                more_pending = started[0] < to_process
+            finished[name].set()
+            throttle.record(status)
+            
+            # Delay before this worker picks up the next device
+            if more_pending:
+                STOP_EVENT.wait(throttle.delay)
+        finally:
+            _LOG_CONTEXT.prefix = ""
+    
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [
+            executor.submit(process, idx, dev)
+            for idx, dev in enumerate(filtered_devices, start=1)
+        ]
+        for future in as_completed(futures):
+            future.result()
+            if STOP_EVENT.is_set():
+                log("")
+                log("⚠ Stop requested; saving progress and exiting")
+                executor.shutdown(wait=True, cancel_futures=True)
+                break
+    
+    # Fold the journal back into the progress file
+    save_progress(progress)
     
     # Final summary
     log_header("Summary")
     log(f"Total devices: {total}")
-    log(f"Successfully updated: {len(done)}")
-    log(f"Failed: {len(failed)}")
-    log(f"Skipped: {len(skipped)}")
+    log(f"Successfully updated: {len(progress['done'])}")
+    log(f"Failed: {len(progress['failed'])}")
+    log(f"Skipped: {len(progress['skipped'])}")
     
-    if failed:
+    if progress["failed"]:
         log("")
         log("Failed devices:")
-        for name in sorted(failed):
-            log(f"  • {name}")
+        for name, entry in sorted(progress["failed"].items()):
+            log(f"  • {name}: {entry.get('last_reason') or 'failed'} "
+                f"(attempt {entry['attempts']}, retry after "
+                f"{datetime.fromtimestamp(entry['next_retry_at']).strftime('%H:%M')})")
     
-    if dry_run:
+    if ctx.dry_run:
         log("")
         log("⚠ DRY RUN MODE - No actual changes were made")
     